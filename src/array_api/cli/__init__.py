@@ -1,3 +1,12 @@
-from .cli import app
+from typing import Any
 
 __all__ = ["app"]
+
+
+def __getattr__(name: str) -> Any:
+    # build the app lazily, importing Typer takes most of the startup time
+    if name == "app":
+        from .cli import _build_app
+
+        return _build_app()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
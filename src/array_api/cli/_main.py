@@ -1,32 +1,63 @@
 from __future__ import annotations
 
 import ast
-import warnings
+import hashlib
+import inspect
+import logging
+import os
+import pickle
+import sys
+import time
 from collections import defaultdict
-from collections.abc import Iterable, Sequence
-from copy import deepcopy
+from collections.abc import Callable, Collection, Iterable, Iterator, Sequence
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from functools import cache, cached_property
+from itertools import chain, repeat
 from pathlib import Path
+from typing import Any
 
 import attrs
 
+from .. import __version__
 
-@attrs.frozen()
+_LOGGER = logging.getLogger(__name__)
+
+_ARRAY_API_URL = "https://github.com/data-apis/array-api"
+# Stub files which are not parsed at all (__init__.py only re-exports the other submodules)
+_SKIPPED_STUBS = frozenset({"__init__.py"})
+# Seconds after which the cloned array-api repository is updated again
+_REFRESH_INTERVAL = 24 * 60 * 60
+
+# Submodules which are separate namespaces rather than part of the main namespace
+_OPTIONAL_SUBMODULES: frozenset[str] = frozenset({"fft", "linalg"})
+
+# Bump the prefix to invalidate all cached ASTs on an incompatible change
+_AST_CACHE_MAGIC = f"array-api-ast-cache:{__version__}:{sys.version_info[0]}.{sys.version_info[1]}\n".encode()
+
+# Read-only nodes shared by all generated Protocols, `ast.unparse` never mutates them
+_PROTOCOL_BASE = ast.Name(id="Protocol")
+_RUNTIME_CHECKABLE = ast.Name(id="runtime_checkable")
+_ABSTRACTMETHOD = ast.Name(id="abstractmethod")
+_ELLIPSIS_EXPR = ast.Expr(value=ast.Constant(value=Ellipsis))
+
+
+@attrs.frozen(eq=False)
 class TypeVarInfo:
     name: str
     bound: str | None = None
 
 
-@attrs.frozen()
+@attrs.frozen(eq=False)
 class ProtocolData:
     stmt: ast.ClassDef
     typevars_used: Iterable[TypeVarInfo]
 
-    @property
+    @cached_property
     def name(self) -> ast.Subscript:
         return ast.Subscript(
-            value=ast.Name(id=self.stmt.name, ctx=ast.Load()),
+            value=_name(self.stmt.name),
             slice=ast.Tuple(
-                elts=[ast.Name(id=t.name) for t in self.typevars_used],
+                elts=[_name(t.name) for t in self.typevars_used],
                 ctx=ast.Load(),
             ),
             ctx=ast.Load(),
@@ -41,7 +72,157 @@ class ModuleAttributes:
     typevars_used: Iterable[TypeVarInfo]
 
 
-def _function_to_protocol(stmt: ast.FunctionDef, typevars: Sequence[TypeVarInfo]) -> ProtocolData:
+@attrs.define()
+class _SubmoduleAttributes:
+    """The attributes of a submodule and the type variables used by them."""
+
+    attributes: list[ModuleAttributes] = attrs.Factory(list)
+    typevars_used: set[TypeVarInfo] = attrs.Factory(set)
+
+    def append(self, attribute: ModuleAttributes) -> None:
+        """Add an attribute, keeping track of the type variables used."""
+        self.attributes.append(attribute)
+        self.typevars_used.update(attribute.typevars_used)
+
+
+def _names_in(node: ast.AST) -> set[str]:
+    """
+    Collect the identifiers of all names in the given node.
+
+    Parameters
+    ----------
+    node : ast.AST
+        The node to search.
+
+    Returns
+    -------
+    set[str]
+        The identifiers of all `ast.Name` nodes in the node.
+
+    """
+    return {n.id for n in ast.walk(node) if isinstance(n, ast.Name)}
+
+
+def _annotation_names(stmt: ast.ClassDef) -> set[str]:
+    """
+    Collect the identifiers of the names used in the annotations and bases of a class.
+
+    Type variables can only be referenced there, so the docstrings,
+    default values and decorators need not be searched.
+
+    Parameters
+    ----------
+    stmt : ast.ClassDef
+        The class definition to search.
+
+    Returns
+    -------
+    set[str]
+        The identifiers of all `ast.Name` nodes in the annotations and bases.
+
+    """
+    names: set[str] = set()
+    for base in stmt.bases:
+        names |= _names_in(base)
+    for node in ast.walk(stmt):
+        if isinstance(node, ast.AnnAssign | ast.arg) and node.annotation is not None:
+            names |= _names_in(node.annotation)
+        elif isinstance(node, ast.FunctionDef | ast.AsyncFunctionDef) and node.returns is not None:
+            names |= _names_in(node.returns)
+    return names
+
+
+@cache
+def _name(id: str) -> ast.Name:
+    """
+    Get a `ast.Name` node shared by all Protocols.
+
+    `ast.unparse` only reads the nodes and `_Rename` replaces them,
+    so the returned node must never be mutated.
+
+    Parameters
+    ----------
+    id : str
+        The identifier of the name.
+
+    Returns
+    -------
+    ast.Name
+        The shared node.
+
+    """
+    return ast.Name(id=id)
+
+
+def _ast_clone[T: ast.AST](node: T) -> T:
+    """
+    Shallow copy an AST node, including its location.
+
+    The child nodes are shared with the original node,
+    so only the fields of the copy itself may be reassigned.
+
+    Parameters
+    ----------
+    node : T
+        The node to copy.
+
+    Returns
+    -------
+    T
+        The copy of the node.
+
+    """
+    return ast.copy_location(type(node)(**{field: getattr(node, field) for field in node._fields if hasattr(node, field)}), node)
+
+
+class _Rename(ast.NodeTransformer):
+    """
+    Rename names, type parameters and classes in a single traversal.
+
+    Matching `ast.Name` nodes are replaced rather than mutated,
+    so that nodes shared between Protocols (see `_name`) stay intact.
+    The targets of annotated assignments (e.g. "dtype: dtype") are kept
+    as they are attribute names rather than references to the type variables.
+
+    Parameters
+    ----------
+    renamed : dict[str, str]
+        The mapping from the original to the new names (and type parameter names).
+    classes_renamed : dict[str, str]
+        The mapping from the original to the new class names.
+
+    """
+
+    def __init__(self, renamed: dict[str, str], classes_renamed: dict[str, str]) -> None:
+        self.renamed = renamed
+        self.classes_renamed = classes_renamed
+
+    def visit_Name(self, node: ast.Name) -> ast.Name:
+        renamed = self.renamed.get(node.id)
+        if renamed is None:
+            return node
+        return ast.copy_location(ast.Name(id=renamed), node)
+
+    def visit_AnnAssign(self, node: ast.AnnAssign) -> ast.AnnAssign:
+        node.annotation = self.visit(node.annotation)
+        if node.value is not None:
+            node.value = self.visit(node.value)
+        if not isinstance(node.target, ast.Name):
+            node.target = self.visit(node.target)
+        return node
+
+    def visit_TypeVar(self, node: ast.TypeVar) -> ast.TypeVar:
+        node.name = self.renamed.get(node.name, node.name)
+        self.generic_visit(node)
+        return node
+
+    def visit_ClassDef(self, node: ast.ClassDef) -> ast.ClassDef:
+        node.name = self.classes_renamed.get(node.name, node.name)
+        self.generic_visit(node)
+        return node
+
+
+def _function_to_protocol(stmt: ast.FunctionDef, typevars: Sequence[TypeVarInfo], *, docstring: str | None, names: set[str]) -> ProtocolData:
     """
     Convert a function definition to a Protocol class.
 
@@ -51,6 +232,11 @@ def _function_to_protocol(stmt: ast.FunctionDef, typevars: Sequence[TypeVarInfo]
         The function definition to convert.
     typevars : Sequence[TypeVarInfo]
         The type variables used in the function.
+    docstring : str | None
+        The (uncleaned) docstring of the function,
+        i.e. `ast.get_docstring(stmt, clean=False)`.
+    names : set[str]
+        The identifiers used in the function, i.e. `_names_in(stmt)`.
 
     Returns
     -------
@@ -58,38 +244,50 @@ def _function_to_protocol(stmt: ast.FunctionDef, typevars: Sequence[TypeVarInfo]
         A ProtocolData object containing the converted function definition.
 
     """
-    stmt = deepcopy(stmt)
     name = stmt.name
-    docstring = ast.get_docstring(stmt, False)
-    stmt.name = "__call__"
-    stmt.body = [ast.Expr(value=ast.Constant(value=Ellipsis))]
-    stmt.args.posonlyargs.insert(0, ast.arg(arg="self"))
-    stmt.decorator_list.append(ast.Name(id="abstractmethod"))
-    # Literal[inf] not allowed
-    if "norm" in name:
-        stmt.type_comment = "ignore[valid-type]"
+    returns = stmt.returns
     # __array_namespace_info__ is a special case
-    if isinstance(stmt.returns, ast.Name) and stmt.returns.id == "Info":
-        stmt.returns = ast.Subscript(
-            value=ast.Name(id="Info"),
+    if isinstance(returns, ast.Name) and returns.id == "Info":
+        returns = ast.Subscript(
+            value=_name("Info"),
             slice=ast.Tuple(
-                elts=[ast.Name(id=t.name) for t in typevars if t.name in ["device"]],
+                elts=[_name(t.name) for t in typevars if t.name in ["device"]],
                 ctx=ast.Load(),
             ),
         )
-    args = ast.unparse(stmt.args) + (ast.unparse(stmt.returns) if stmt.returns else "")
-    typevars = [typevar for typevar in typevars if typevar.name in args]
+        names = names | _names_in(returns)
+    # build a new __call__ method sharing the (unmodified) argument nodes
+    # instead of deep-copying the whole function definition
+    # the location is needed by `ast.unparse` to look up type comments
+    call = ast.FunctionDef(
+        name="__call__",
+        args=ast.arguments(
+            posonlyargs=[ast.arg(arg="self"), *stmt.args.posonlyargs],
+            args=stmt.args.args,
+            vararg=stmt.args.vararg,
+            kwonlyargs=stmt.args.kwonlyargs,
+            kw_defaults=stmt.args.kw_defaults,
+            kwarg=stmt.args.kwarg,
+            defaults=stmt.args.defaults,
+        ),
+        body=[_ELLIPSIS_EXPR],
+        decorator_list=[*stmt.decorator_list, _ABSTRACTMETHOD],
+        returns=returns,
+        # Literal[inf] not allowed
+        type_comment="ignore[valid-type]" if "norm" in name else stmt.type_comment,
+        type_params=stmt.type_params,
+    )
+    ast.copy_location(call, stmt)
+    typevars = [typevar for typevar in typevars if typevar.name in names]
 
     # Construct the protocol
     stmt_new = ast.ClassDef(
         name=name,
-        decorator_list=[ast.Name(id="runtime_checkable")],
+        decorator_list=[_RUNTIME_CHECKABLE],
         keywords=[],
-        bases=[
-            ast.Name(id="Protocol"),
-        ],
-        body=([ast.Expr(value=ast.Constant(docstring))] if docstring is not None else []) + [stmt],
-        type_params=[ast.TypeVar(name=t.name, bound=ast.Name(id=t.bound) if t.bound else None) for t in typevars],
+        bases=[_PROTOCOL_BASE],
+        body=([ast.Expr(value=ast.Constant(docstring))] if docstring is not None else []) + [call],
+        type_params=[ast.TypeVar(name=t.name, bound=_name(t.bound) if t.bound else None) for t in typevars],
     )
     return ProtocolData(
         stmt=stmt_new,
@@ -97,7 +295,7 @@ def _function_to_protocol(stmt: ast.FunctionDef, typevars: Sequence[TypeVarInfo]
     )
 
 
-def _class_to_protocol(stmt: ast.ClassDef, typevars: Sequence[TypeVarInfo]) -> ProtocolData:
+def _class_to_protocol(stmt: ast.ClassDef, typevars: Sequence[TypeVarInfo], *, names: set[str]) -> ProtocolData:
     """
     Convert a class definition to a Protocol class.
 
@@ -107,6 +305,8 @@ def _class_to_protocol(stmt: ast.ClassDef, typevars: Sequence[TypeVarInfo]) -> P
         The class definition to convert.
     typevars : Sequence[TypeVarInfo]
         The type variables used in the class.
+    names : set[str]
+        The identifiers used in the annotations of the class, i.e. `_annotation_names(stmt)`.
 
     Returns
     -------
@@ -114,9 +314,8 @@ def _class_to_protocol(stmt: ast.ClassDef, typevars: Sequence[TypeVarInfo]) -> P
         The ProtocolData object containing the converted class definition.
 
     """
-    unp = ast.unparse(stmt)
     # extract type variables from the class definition
-    typevars = [typevar for typevar in typevars if f": {typevar.name}" in unp or f"-> {typevar.name}" in unp or f"[{typevar.name}]" in unp]
+    typevars = [typevar for typevar in typevars if typevar.name in names]
     # Array must not be a generic of itself
     if stmt.name == "_array":
         typevars = [t for t in typevars if t.name != "array"]
@@ -124,16 +323,14 @@ def _class_to_protocol(stmt: ast.ClassDef, typevars: Sequence[TypeVarInfo]) -> P
             if isinstance(node, ast.Name) and node.id == "array":
                 node.id = "Self"
         stmt.name = "_array"
-    stmt.bases = [
-        ast.Name(id="Protocol"),
-    ]
+    stmt.bases = [_PROTOCOL_BASE]
     to_extend = []
     for b in stmt.body:
         if isinstance(b, ast.FunctionDef):
             if getattr(b.body[-1].value, "value", None) is Ellipsis:  # type: ignore[attr-defined]
                 pass
             else:
-                b.body.append(ast.Expr(value=ast.Constant(value=Ellipsis)))
+                b.body.append(_ELLIPSIS_EXPR)
             if b.name in ["__eq__", "__ne__"]:
                 b.type_comment = "ignore[override]"
             if b.name == "__array_namespace__":
@@ -160,19 +357,19 @@ def _class_to_protocol(stmt: ast.ClassDef, typevars: Sequence[TypeVarInfo]) -> P
                 "rshift",
             ]
             if (clean_name := b.name.replace("__", "", 2)) in hasr:
-                b = deepcopy(b)
+                b = _ast_clone(b)
                 b.name = f"__r{clean_name}__"
                 to_extend.append(b)
     stmt.body.extend(to_extend)
-    stmt.type_params = [ast.TypeVar(name=t.name, bound=ast.Name(id=t.bound) if t.bound else None) for t in typevars]
-    stmt.decorator_list = [ast.Name(id="runtime_checkable")]
+    stmt.type_params = [ast.TypeVar(name=t.name, bound=_name(t.bound) if t.bound else None) for t in typevars]
+    stmt.decorator_list = [_RUNTIME_CHECKABLE]
     return ProtocolData(
         stmt=stmt,
         typevars_used=typevars,
     )
 
 
-def _attributes_to_protocol(name: str, attributes: Sequence[ModuleAttributes], /, *, typevars: Sequence[TypeVarInfo], bases: list[ast.expr] | None = None, typevars_force: Sequence[TypeVarInfo] | None = None) -> ProtocolData:
+def _attributes_to_protocol(name: str, attributes: Sequence[ModuleAttributes], /, *, typevars: Sequence[TypeVarInfo], typevars_used: Collection[TypeVarInfo], bases: list[ast.expr] | None = None) -> ProtocolData:
     """
     Convert a list of module attributes to a Protocol class.
 
@@ -185,9 +382,9 @@ def _attributes_to_protocol(name: str, attributes: Sequence[ModuleAttributes], /
     bases : list[ast.expr] | None, optional
         The base classes for the Protocol class, by default None, which defaults to [Protocol].
     typevars : Sequence[TypeVarInfo]
-        The type variables used in the class.
-    typevars_force : Sequence[TypeVarInfo] | None, optional
-        The type variables used in the Protocol class, by default None, which defaults to the type variables used in the attributes.
+        All type variables, which determine the order of the type parameters.
+    typevars_used : Collection[TypeVarInfo]
+        The type variables used in the Protocol class, usually the type variables used in the attributes.
 
     Returns
     -------
@@ -195,35 +392,142 @@ def _attributes_to_protocol(name: str, attributes: Sequence[ModuleAttributes], /
         The ProtocolData object containing the converted attributes.
 
     """
-    body: list[ast.stmt] = []
-    for a in attributes:
-        body.append(
-            ast.AnnAssign(
-                target=ast.Name(id=a.name),
-                annotation=a.type,
-                simple=1,
-            )
-        )
-        if a.docstring is not None:
-            body.append(ast.Expr(value=ast.Constant(a.docstring)))
-    if typevars_force is None:
-        typevars_force = [t for t in typevars if any(t in attr.typevars_used for attr in attributes)]
+    body: list[ast.stmt] = list(chain.from_iterable((ast.AnnAssign(target=_name(a.name), annotation=a.type, simple=1),) + ((ast.Expr(value=ast.Constant(a.docstring)),) if a.docstring is not None else ()) for a in attributes))
+    typevars_used = [t for t in typevars if t in typevars_used]
     return ProtocolData(
         stmt=ast.ClassDef(
             name=name,
-            decorator_list=[ast.Name(id="runtime_checkable")],
+            decorator_list=[_RUNTIME_CHECKABLE],
             keywords=[],
-            bases=(bases if bases else [])
-            + [
-                ast.Name(id="Protocol"),
-            ],
+            bases=(bases if bases else []) + [_PROTOCOL_BASE],
             body=body,
-            type_params=[ast.TypeVar(name=t.name, bound=ast.Name(id=t.bound) if t.bound else None) for t in typevars_force],
+            type_params=[ast.TypeVar(name=t.name, bound=_name(t.bound) if t.bound else None) for t in typevars_used],
         ),
-        typevars_used=typevars_force,
+        typevars_used=typevars_used,
     )
 
 
+def _unparse_body(body: Sequence[ast.stmt]) -> Iterator[str]:
+    """
+    Unparse the statements one by one.
+
+    The concatenated chunks are identical to `ast.unparse` of the whole module
+    (definitions are preceded by a blank line), but the source of the (large)
+    module never needs to be held in memory at once.
+
+    Parameters
+    ----------
+    body : Sequence[ast.stmt]
+        The statements to unparse.
+
+    Yields
+    ------
+    str
+        The source code of each statement, preceded by the separator.
+
+    """
+    for i, stmt in enumerate(body):
+        if i:
+            yield "\n\n" if isinstance(stmt, ast.ClassDef | ast.FunctionDef | ast.AsyncFunctionDef) else "\n"
+        yield ast.unparse(stmt)
+
+
+@attrs.define()
+class _GenerateState:
+    """The state shared by the statement handlers while generating a module."""
+
+    typevars: Sequence[TypeVarInfo]
+    module_attributes: defaultdict[str, _SubmoduleAttributes]
+    out: ast.Module
+    # Statements to add to the first position, in reverse order
+    # (collected separately as inserting at the front is O(n) each)
+    head: list[ast.stmt]
+    # The submodule of the statements currently handled
+    submodule: str = ""
+
+
+def _handle_function(b: ast.FunctionDef, i: int, body: list[ast.stmt], state: _GenerateState) -> None:
+    """Create a Protocol with __call__ representing the function."""
+    # implemented in object rather than Namespace
+    if b.name == "__eq__":
+        return
+    # info.py contains functions which are not part of the Namespace (but Info class)
+    if state.submodule == "info" and b.name != "__array_namespace_info__":
+        return
+    docstring = ast.get_docstring(b, clean=False)
+    data = _function_to_protocol(b, state.typevars, docstring=docstring, names=_names_in(b))
+    if docstring is not None:
+        docstring = inspect.cleandoc(docstring)
+    # add to module attributes
+    state.module_attributes[state.submodule].append(ModuleAttributes(b.name, data.name, docstring, data.typevars_used))
+    # some functions are duplicated in linalg and fft, skip them
+    # their docstrings are unhelpful, e.g. "Alias for ..."
+    if "Alias" in (docstring or ""):
+        return
+    # add to output
+    state.out.body.append(data.stmt)
+
+
+def _handle_assign(b: ast.Assign, i: int, body: list[ast.stmt], state: _GenerateState) -> None:
+    """Add the assigned constant to the module attributes."""
+    # _types.py contains Assigns which are not part of the Namespace
+    if state.submodule == "_types":
+        if isinstance(b.targets[0], ast.Name) and b.targets[0].id in ["Capabilities", "DefaultDataTypes", "DataTypes"]:
+            b = ast.parse(ast.unparse(b).replace("dtype", "Any"))  # type: ignore
+            state.head.append(b)
+        return
+    if not isinstance(b.targets[0], ast.Name):
+        return
+    id = b.targets[0].id
+    # __init__.py
+    if id == "__all__":
+        return
+    # weird assignment
+    if id == "array":
+        return
+    # get docstring
+    docstring = None
+    if i != len(body) - 1:
+        docstring_expr = body[i + 1]
+        if isinstance(docstring_expr, ast.Expr):
+            if isinstance(docstring_expr.value, ast.Constant):
+                if isinstance(docstring_expr.value.value, str):
+                    docstring = docstring_expr.value.value
+    # add to module attributes
+    state.module_attributes[state.submodule].append(ModuleAttributes(id, _name("array"), docstring, []))
+
+
+def _handle_class(b: ast.ClassDef, i: int, body: list[ast.stmt], state: _GenerateState) -> None:
+    """Convert the class to a Protocol."""
+    data = _class_to_protocol(b, state.typevars, names=_annotation_names(b))
+    # add to output, do not add to module attributes
+    # add to first position
+    state.head.append(data.stmt)
+
+
+def _handle_skip(b: ast.stmt, i: int, body: list[ast.stmt], state: _GenerateState) -> None:
+    """Ignore the statement (imports and docstrings)."""
+
+
+def _handle_unknown(b: ast.stmt, i: int, body: list[ast.stmt], state: _GenerateState) -> None:
+    """Warn about a statement which is not supported."""
+    # formatted lazily by logging
+    _LOGGER.warning("Skipping %s %s", state.submodule, b)
+
+
+# Handlers for each type of top-level statement in the stubs,
+# looked up by the exact type instead of a chain of isinstance checks
+# (the statement is Any here as each handler narrows it to its own type)
+_HANDLERS: dict[type[ast.stmt], Callable[[Any, int, list[ast.stmt], _GenerateState], None]] = {
+    ast.FunctionDef: _handle_function,
+    ast.Assign: _handle_assign,
+    ast.ClassDef: _handle_class,
+    ast.Import: _handle_skip,
+    ast.ImportFrom: _handle_skip,
+    ast.Expr: _handle_skip,
+}
+
+
 def generate(body_module: dict[str, list[ast.stmt]], out_path: Path) -> None:
     """
     Generate Protocol classes from the given module body.
@@ -236,124 +540,62 @@ def generate(body_module: dict[str, list[ast.stmt]], out_path: Path) -> None:
         The output path where the generated Protocol classes will be saved.
 
     """
-    body_module["_types"]
-    del body_module["__init__"]
+    if "_types" not in body_module:
+        raise RuntimeError("array-api repo layout changed: _types.py missing")
+    # not part of the namespace, generate_all does not even parse it
+    body_module.pop("__init__", None)
 
     # Get all TypeVars
     typevars = [TypeVarInfo("array", "_array"), TypeVarInfo("dtype"), TypeVarInfo("device"), TypeVarInfo("_T_co")]
 
     # Dict of module attributes per submodule
-    module_attributes: defaultdict[str, list[ModuleAttributes]] = defaultdict(list)
+    module_attributes: defaultdict[str, _SubmoduleAttributes] = defaultdict(_SubmoduleAttributes)
 
     # Import `abc.abstractmethod`, `typing.Protocol` and `typing.runtime_checkable`
     out = ast.Module(body=[], type_ignores=[])
+    state = _GenerateState(typevars, module_attributes, out, [])
 
     # Create Protocols with __call__, representing functions
     for submodule, body in body_module.items():
+        state.submodule = submodule
         for i, b in enumerate(body):
-            if isinstance(b, ast.Import | ast.ImportFrom):
-                pass
-            elif isinstance(b, ast.FunctionDef):
-                # implemented in object rather than Namespace
-                if b.name == "__eq__":
-                    continue
-                # info.py contains functions which are not part of the Namespace (but Info class)
-                if submodule == "info" and b.name != "__array_namespace_info__":
-                    continue
-                data = _function_to_protocol(b, typevars)
-                docstring = ast.get_docstring(b)
-                # add to module attributes
-                module_attributes[submodule].append(ModuleAttributes(b.name, data.name, docstring, data.typevars_used))
-                # some functions are duplicated in linalg and fft, skip them
-                # their docstrings are unhelpful, e.g. "Alias for ..."
-                if "Alias" in (ast.get_docstring(b) or ""):
-                    continue
-                # add to output
-                out.body.append(data.stmt)
-            elif isinstance(b, ast.Assign):
-                # _types.py contains Assigns which are not part of the Namespace
-                if submodule == "_types":
-                    if isinstance(b.targets[0], ast.Name) and b.targets[0].id in ["Capabilities", "DefaultDataTypes", "DataTypes"]:
-                        b = ast.parse(ast.unparse(b).replace("dtype", "Any"))  # type: ignore
-                        out.body = [b, *out.body]
-                    continue
-                if not isinstance(b.targets[0], ast.Name):
-                    continue
-                id = b.targets[0].id
-                # __init__.py
-                if id == "__all__":
-                    continue
-                # weird assignment
-                if id == "array":
-                    continue
-                # get docstring
-                docstring = None
-                if i != len(body) - 1:
-                    docstring_expr = body[i + 1]
-                    if isinstance(docstring_expr, ast.Expr):
-                        if isinstance(docstring_expr.value, ast.Constant):
-                            if isinstance(docstring_expr.value.value, str):
-                                docstring = docstring_expr.value.value
-                # add to module attributes
-                module_attributes[submodule].append(ModuleAttributes(id, ast.Name(id="array"), docstring, []))
-            elif isinstance(b, ast.ClassDef):
-                data = _class_to_protocol(b, typevars)
-                # add to output, do not add to module attributes
-                # add to first position
-                out.body.insert(0, data.stmt)
-            elif isinstance(b, ast.Expr):
-                pass
-            else:
-                warnings.warn(f"Skipping {submodule} {b}", stacklevel=2)
+            _HANDLERS.get(type(b), _handle_unknown)(b, i, body, state)
+    out.body[:0] = reversed(state.head)
 
     # Manual addition
     for d in ["bool", "complex128", "complex64", "float32", "float64", "int16", "int32", "int64", "int8", "uint16", "uint32", "uint64", "uint8"]:
-        module_attributes[""].append(ModuleAttributes(d, ast.Name("dtype"), None, []))
-    module_attributes[""].append(ModuleAttributes("Device", ast.Name("device"), None, []))
+        module_attributes[""].append(ModuleAttributes(d, _name("dtype"), None, []))
+    module_attributes[""].append(ModuleAttributes("Device", _name("device"), None, []))
 
-    # Create Protocols for the main namespace
-    OPTIONAL_SUBMODULES = ["fft", "linalg"]
-    main_attributes = [attribute for submodule, attributes in module_attributes.items() for attribute in attributes if submodule not in OPTIONAL_SUBMODULES]
-    main_protocol = _attributes_to_protocol("ArrayNamespace", main_attributes, typevars=typevars).stmt
-    out.body.append(main_protocol)
-
-    # Create Protocols for fft and linalg
+    # Collect the attributes of the main namespace and create Protocols for fft and linalg in a single pass
+    main_attributes: list[ModuleAttributes] = []
+    main_typevars_used: set[TypeVarInfo] = set()
+    submodule_protocols: list[ast.stmt] = []
     submodules: list[ModuleAttributes] = []
     for submodule, attributes in module_attributes.items():
-        if submodule not in OPTIONAL_SUBMODULES:
-            continue
-        data = _attributes_to_protocol(submodule[0].upper() + submodule[1:] + "Namespace", attributes, typevars=typevars)
-        out.body.append(data.stmt)
-        if submodule in OPTIONAL_SUBMODULES:
-            submodules.append(ModuleAttributes(submodule, data.name, None, [t for t in typevars if any(t in attr.typevars_used for attr in attributes)]))
+        if submodule in _OPTIONAL_SUBMODULES:
+            data = _attributes_to_protocol(submodule[0].upper() + submodule[1:] + "Namespace", attributes.attributes, typevars=typevars, typevars_used=attributes.typevars_used)
+            submodule_protocols.append(data.stmt)
+            submodules.append(ModuleAttributes(submodule, data.name, None, data.typevars_used))
+        else:
+            main_attributes.extend(attributes.attributes)
+            main_typevars_used |= attributes.typevars_used
+
+    # Create Protocols for the main namespace, followed by fft and linalg
+    main_data = _attributes_to_protocol("ArrayNamespace", main_attributes, typevars=typevars, typevars_used=main_typevars_used)
+    main_protocol = main_data.stmt
+    out.body.append(main_protocol)
+    out.body.extend(submodule_protocols)
 
     # Create Full Protocol for the main namespace
-    out.body.append(_attributes_to_protocol("ArrayNamespaceFull", submodules, bases=[ast.Subscript(ast.Name("ArrayNamespace"), ast.Tuple([ast.Name(t.name) for t in main_protocol.type_params]))], typevars=typevars, typevars_force=[t for t in typevars if t.name in [s.name for s in main_protocol.type_params]]).stmt)  # type: ignore
+    out.body.append(_attributes_to_protocol("ArrayNamespaceFull", submodules, bases=[ast.Subscript(_name("ArrayNamespace"), ast.Tuple([_name(t.name) for t in main_protocol.type_params]))], typevars=typevars, typevars_used=main_data.typevars_used).stmt)  # type: ignore
 
     # Replace TypeVars because of the name conflicts like "array: array"
-    for node in ast.walk(out):
-        for child in ast.iter_child_nodes(node):
-            if isinstance(child, ast.Name) and child.id in {t.name for t in typevars}:
-                if isinstance(node, ast.AnnAssign):
-                    node.annotation = ast.Name(id="T" + child.id.capitalize())
-                else:
-                    child.id = "T" + child.id.capitalize()
-            elif isinstance(child, ast.TypeVar) and child.name in {t.name for t in typevars}:
-                child.name = "T" + child.name.capitalize()
-
-    # Replace _array with Array
-    for node in ast.walk(out):
-        if isinstance(node, ast.Name) and node.id == "_array":
-            node.id = "Array"
-        if isinstance(node, ast.ClassDef) and node.name == "_array":
-            node.name = "Array"
-
-    # Manual modifications (easier than AST manipulations)
-    text = ast.unparse(ast.fix_missing_locations(out))
+    # and replace _array with Array
+    out = _Rename({t.name: "T" + t.name.capitalize() for t in typevars} | {"_array": "Array"}, {"_array": "Array"}).visit(out)
 
     # Add imports
-    text = (
-        """from __future__ import annotations
+    header = """from __future__ import annotations
 
 from enum import Enum
 from abc import abstractmethod
@@ -376,8 +618,7 @@ from collections.abc import Buffer as SupportsBufferProtocol
 inf = float("inf")
 
 """
-        + text
-        + """
+    footer = """
 @runtime_checkable
 class ShapedArray[*T, TDevice, TDtype](Array[TDevice, TDtype], Protocol):
     @property
@@ -386,15 +627,230 @@ class ShapedArray[*T, TDevice, TDtype](Array[TDevice, TDtype], Protocol):
 
 type ShapedAnyArray[*T] = ShapedArray[*T, Any, Any]
 """
-    )
 
     # Fix self-references in typing
     ns = "Union[T_t_co, NestedSequence[T_t_co]]"
-    text = text.replace(ns, f'"{ns}"')
 
-    # write to the output path
+    # write to the output path statement by statement
+    # manual modifications (easier than AST manipulations) are applied to each statement
     out_path.parent.mkdir(parents=True, exist_ok=True)
-    out_path.write_text(text, "utf-8")
+    # write to a temporary file first so that a failure never leaves a truncated module behind
+    tmp_path = out_path.with_suffix(f".{os.getpid()}.tmp")
+    try:
+        with tmp_path.open("w", encoding="utf-8") as f:
+            f.write(header)
+            for chunk in _unparse_body(out.body):
+                f.write(chunk.replace(ns, f'"{ns}"'))
+            f.write(footer)
+        tmp_path.replace(out_path)
+    finally:
+        tmp_path.unlink(missing_ok=True)
+
+
+def _read_stub(path: Path) -> bytes:
+    """
+    Read a stub file and normalize the names of the type variables.
+
+    Parameters
+    ----------
+    path : Path
+        The path to the stub file.
+
+    Returns
+    -------
+    bytes
+        The normalized source code.
+
+    """
+    # work on bytes, the tokenizer handles the decoding itself
+    return path.read_bytes().replace(b"self: array", b"self").replace(b"Dtype", b"dtype").replace(b"Device", b"device")
+
+
+def _ast_cache_dir(cache_dir: Path) -> Path:
+    """
+    Get the directory of the pickled ASTs.
+
+    Parameters
+    ----------
+    cache_dir : Path
+        The directory where the array-api repository is cloned.
+
+    Returns
+    -------
+    Path
+        The directory of the pickled ASTs, inside ".git" so that the checkout stays clean.
+
+    """
+    return cache_dir / ".git" / "ast-cache"
+
+
+def _ast_cache_path(source: bytes, cache_dir: Path) -> Path:
+    """
+    Get the path of the pickled AST of the given source code.
+
+    Parameters
+    ----------
+    source : bytes
+        The normalized source code.
+    cache_dir : Path
+        The directory where the array-api repository is cloned.
+
+    Returns
+    -------
+    Path
+        The path of the pickled AST, which may not exist yet.
+
+    """
+    key = hashlib.sha256(source + _AST_CACHE_MAGIC).hexdigest()
+    return _ast_cache_dir(cache_dir) / f"{key}.pkl"
+
+
+def _prune_ast_cache(cache_dir: Path, keep: Collection[Path]) -> None:
+    """
+    Remove the pickled ASTs which are not used by the current stubs.
+
+    Parameters
+    ----------
+    cache_dir : Path
+        The directory where the array-api repository is cloned.
+    keep : Collection[Path]
+        The paths of the pickled ASTs of the current stubs.
+
+    """
+    # temporary files of concurrent writers do not match
+    for path in _ast_cache_dir(cache_dir).glob("*.pkl"):
+        if path not in keep:
+            path.unlink(missing_ok=True)
+
+
+def _parse_cached(path: Path, cache_dir: Path) -> list[ast.stmt]:
+    """
+    Parse a stub file, reusing the pickled AST from a previous run if available.
+
+    Parameters
+    ----------
+    path : Path
+        The path to the stub file.
+    cache_dir : Path
+        The directory where the array-api repository is cloned.
+        The ASTs are stored in ".git/ast-cache" so that the checkout stays clean.
+
+    Returns
+    -------
+    list[ast.stmt]
+        The body of the parsed module.
+        A new tree is returned for every call, so it may be modified freely.
+
+    """
+    stat = path.stat()
+    try:
+        return pickle.loads(_pickled_ast(str(path), stat.st_mtime_ns, stat.st_size, str(cache_dir)))  # noqa: S301
+    except (pickle.UnpicklingError, AttributeError, EOFError, ImportError, IndexError):
+        # the header is intact but the pickle is not (e.g. truncated), parse again and overwrite it
+        _ast_cache_path(_read_stub(path), cache_dir).unlink(missing_ok=True)
+        _pickled_ast.cache_clear()
+        return pickle.loads(_pickled_ast(str(path), stat.st_mtime_ns, stat.st_size, str(cache_dir)))  # noqa: S301
+
+
+@cache
+def _pickled_ast(path: str, mtime_ns: int, size: int, cache_dir: str) -> bytes:
+    """
+    Get the pickled AST of a stub file, from the cache directory or by parsing it.
+
+    The result is also kept in memory, keyed by the modification time and size of the file,
+    so repeated calls in the same process neither read the cache directory nor parse again.
+
+    Parameters
+    ----------
+    path : str
+        The path to the stub file.
+    mtime_ns : int
+        The modification time of the stub file, only used as part of the key.
+    size : int
+        The size of the stub file, only used as part of the key.
+    cache_dir : str
+        The cache directory.
+
+    Returns
+    -------
+    bytes
+        The pickled body of the parsed module.
+
+    """
+    source = _read_stub(Path(path))
+    cache_path = _ast_cache_path(source, Path(cache_dir))
+    if cache_path.exists():
+        data = cache_path.read_bytes()
+        if data.startswith(_AST_CACHE_MAGIC):
+            return data[len(_AST_CACHE_MAGIC) :]
+    data = pickle.dumps(ast.parse(source, filename=path).body, protocol=5)
+    # write to a temporary file first so that concurrent runs never see a partial file
+    cache_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = cache_path.with_suffix(f".{os.getpid()}.tmp")
+    tmp_path.write_bytes(_AST_CACHE_MAGIC + data)
+    tmp_path.replace(cache_path)
+    return data
+
+
+def _stub_paths(dir_path: Path) -> list[Path]:
+    """
+    List the stub files to generate Protocol classes from.
+
+    Parameters
+    ----------
+    dir_path : Path
+        The directory containing the stubs.
+
+    Returns
+    -------
+    list[Path]
+        The paths to the stub files, excluding those in `_SKIPPED_STUBS`.
+
+    """
+    return [path for path in dir_path.rglob("*.py") if path.name not in _SKIPPED_STUBS]
+
+
+def _warm_ast_cache(path: Path, cache_dir: Path) -> Path:
+    """
+    Parse a stub file into the AST cache unless it is already cached.
+
+    Parameters
+    ----------
+    path : Path
+        The path to the stub file.
+    cache_dir : Path
+        The cache directory.
+
+    Returns
+    -------
+    Path
+        The path of the pickled AST.
+
+    """
+    cache_path = _ast_cache_path(_read_stub(path), cache_dir)
+    if not cache_path.exists():
+        stat = path.stat()
+        _pickled_ast(str(path), stat.st_mtime_ns, stat.st_size, str(cache_dir))
+    return cache_path
+
+
+def _process_dir(dir_path: Path, out_path: Path, cache_dir: Path) -> None:
+    """
+    Generate Protocol classes for a single version of the array-api stubs.
+
+    Parameters
+    ----------
+    dir_path : Path
+        The directory containing the stubs, e.g. ".cache/src/array_api_stubs/_2024_12".
+    out_path : Path
+        The directory where the generated module will be saved.
+    cache_dir : Path
+        The cache directory.
+
+    """
+    # get module bodies
+    body_module = {path.stem: _parse_cached(path, cache_dir) for path in _stub_paths(dir_path)}
+    generate(body_module, (out_path / dir_path.name).with_suffix(".py"))
 
 
 def generate_all(
@@ -407,23 +863,52 @@ def generate_all(
     Parameters
     ----------
     cache_dir : Path | str, optional
-        The directory where the array-api repository will be cloned, by default ".cache"
+        The directory where the array-api repository will be cloned, by default ".cache".
+        The parsed stubs are cached in its ".git/ast-cache" subdirectory.
     out_path : Path | str, optional
         The output path where the generated Protocol classes will be saved, by default "src/array_api"
 
     """
     import subprocess as sp
 
-    Path(cache_dir).mkdir(exist_ok=True)
-    sp.run(["git", "clone", "https://github.com/data-apis/array-api", ".cache"])
-
-    for dir_path in (Path(cache_dir) / Path("src") / "array_api_stubs").iterdir():
+    git_dir = Path(cache_dir) / ".git"
+    if git_dir.exists():
+        # FETCH_HEAD is rewritten on every pull, HEAD on the initial clone
+        fetched = git_dir / "FETCH_HEAD" if (git_dir / "FETCH_HEAD").exists() else git_dir / "HEAD"
+        # skip the network entirely if the checkout is recent enough
+        if time.time() - fetched.stat().st_mtime >= _REFRESH_INTERVAL:
+            # only fetch the changed objects
+            try:
+                sp.run(["git", "-C", str(cache_dir), "pull", "--ff-only"], check=True)
+            except sp.CalledProcessError:
+                # offline or upstream history rewritten, the existing checkout is still usable
+                _LOGGER.warning("could not update %s, using the existing checkout", cache_dir)
+    else:
+        # only the latest snapshot is needed, do not download the history
+        sp.run(["git", "clone", "--depth=1", "--single-branch", _ARRAY_API_URL, str(cache_dir)], check=True)
+
+    dir_paths = []
+    stubs_dir = Path(cache_dir) / "src" / "array_api_stubs"
+    if not stubs_dir.is_dir():
+        raise RuntimeError(f"array-api repo layout changed: {stubs_dir} missing")
+    for dir_path in stubs_dir.iterdir():
         # skip non-directory entries
         if not dir_path.is_dir():
             continue
         # 2021 is broken (no self keyword in `_array`` methods)
         if "2021" in dir_path.name:
             continue
-        # get module bodies
-        body_module = {path.stem: ast.parse(path.read_text("utf-8").replace("self: array", "self").replace("Dtype", "dtype").replace("Device", "device")).body for path in dir_path.rglob("*.py")}
-        generate(body_module, (Path(out_path) / dir_path.name).with_suffix(".py"))
+        dir_paths.append(dir_path)
+
+    with ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
+        # parse the files in parallel first so that all cores are used even for few versions,
+        # the workers below then only load the pickled ASTs
+        paths = [path for dir_path in dir_paths for path in _stub_paths(dir_path)]
+        cache_paths = set(executor.map(_warm_ast_cache, paths, repeat(Path(cache_dir))))
+        # drop the ASTs of stubs which changed upstream since they were cached
+        _prune_ast_cache(Path(cache_dir), cache_paths)
+
+        # each version is independent, generate them in parallel
+        futures = [executor.submit(_process_dir, dir_path, Path(out_path), Path(cache_dir)) for dir_path in dir_paths]
+        for future in as_completed(futures):
+            future.result()
@@ -1,11 +1,24 @@
-import typer
+from __future__ import annotations
+
+from functools import cache
+from typing import TYPE_CHECKING
 
 from ._main import generate_all
 
-app = typer.Typer()
+if TYPE_CHECKING:
+    import typer
+
+
+@cache
+def _build_app() -> typer.Typer:
+    """Build the CLI application, importing Typer only when it is needed."""
+    import typer
+
+    app = typer.Typer()
 
+    @app.command()
+    def main() -> None:
+        """Add the arguments and print the result."""
+        generate_all()
 
-@app.command()
-def main() -> None:
-    """Add the arguments and print the result."""
-    generate_all()
+    return app
@@ -0,0 +1,134 @@
+import ast
+import logging
+import os
+import subprocess as sp
+from collections.abc import Iterator
+from pathlib import Path
+from typing import Any
+
+import pytest
+
+from array_api.cli import _main
+from array_api.cli._main import _ast_cache_dir, _parse_cached, _pickled_ast, _prune_ast_cache, generate, generate_all
+
+
+def test_parse_cached(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    path = tmp_path / "stub.py"
+    path.write_text("def f(x: Dtype, /) -> Device: ...\n", "utf-8")
+    cache_dir = tmp_path / "cache"
+    body = _parse_cached(path, cache_dir)
+    assert ast.unparse(body[0]) == "def f(x: dtype, /) -> device:\n    ..."
+    (cache_path,) = _ast_cache_dir(cache_dir).iterdir()
+    # the second call loads the pickled AST from disk into a new tree
+    _pickled_ast.cache_clear()
+    with monkeypatch.context() as m:
+        m.setattr(ast, "parse", lambda *args, **kwargs: pytest.fail("parsed again"))
+        body_cached = _parse_cached(path, cache_dir)
+    assert body_cached[0] is not body[0]
+    assert ast.dump(ast.Module(body_cached, [])) == ast.dump(ast.Module(body, []))
+    assert list(_ast_cache_dir(cache_dir).iterdir()) == [cache_path]
+    # an entry with another header is parsed again and overwritten
+    data = cache_path.read_bytes()
+    cache_path.write_bytes(b"other" + data)
+    _pickled_ast.cache_clear()
+    assert ast.dump(ast.Module(_parse_cached(path, cache_dir), [])) == ast.dump(ast.Module(body, []))
+    assert cache_path.read_bytes() == data
+
+
+def test_parse_cached_in_memory(tmp_path: Path) -> None:
+    path = tmp_path / "stub.py"
+    path.write_text("x: int\n", "utf-8")
+    _parse_cached(path, tmp_path)
+    misses = _pickled_ast.cache_info().misses
+    # unchanged files are answered from memory
+    _parse_cached(path, tmp_path)
+    assert _pickled_ast.cache_info().misses == misses
+    # a new modification time invalidates the entry
+    stat = path.stat()
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1))
+    _parse_cached(path, tmp_path)
+    assert _pickled_ast.cache_info().misses == misses + 1
+    # so does new content, here even with the same modification time
+    stat = path.stat()
+    path.write_text("xy: int\n", "utf-8")
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    assert ast.unparse(_parse_cached(path, tmp_path)[0]) == "xy: int"
+
+
+def test_parse_cached_corrupt(tmp_path: Path) -> None:
+    path = tmp_path / "stub.py"
+    path.write_text("x: int\n", "utf-8")
+    body = _parse_cached(path, tmp_path)
+    (cache_path,) = _ast_cache_dir(tmp_path).iterdir()
+    data = cache_path.read_bytes()
+    # keep the header, truncate the pickle
+    cache_path.write_bytes(data[:-10])
+    _pickled_ast.cache_clear()
+    assert ast.dump(ast.Module(_parse_cached(path, tmp_path), [])) == ast.dump(ast.Module(body, []))
+    assert cache_path.read_bytes() == data
+
+
+def test_prune_ast_cache(tmp_path: Path) -> None:
+    path = tmp_path / "stub.py"
+    path.write_text("x: int\n", "utf-8")
+    _parse_cached(path, tmp_path)
+    (cache_path,) = _ast_cache_dir(tmp_path).iterdir()
+    # an entry for a stub which changed upstream
+    stale_path = _ast_cache_dir(tmp_path) / "stale.pkl"
+    stale_path.write_bytes(b"")
+    _prune_ast_cache(tmp_path, {cache_path})
+    assert list(_ast_cache_dir(tmp_path).iterdir()) == [cache_path]
+
+
+def test_generate_all_refresh_failure(tmp_path: Path, monkeypatch: pytest.MonkeyPatch, caplog: pytest.LogCaptureFixture) -> None:
+    cache_dir = tmp_path / "cache"
+    (cache_dir / ".git").mkdir(parents=True)
+    # make the checkout old enough to be refreshed
+    fetch_head = cache_dir / ".git" / "FETCH_HEAD"
+    fetch_head.touch()
+    os.utime(fetch_head, (0, 0))
+    (cache_dir / "src" / "array_api_stubs").mkdir(parents=True)
+    calls = []
+
+    def run(args: list[str], **kwargs: Any) -> None:
+        calls.append(args)
+        raise sp.CalledProcessError(1, args)
+
+    monkeypatch.setattr(sp, "run", run)
+    with caplog.at_level(logging.WARNING):
+        generate_all(cache_dir=cache_dir, out_path=tmp_path / "out")
+    assert calls == [["git", "-C", str(cache_dir), "pull", "--ff-only"]]
+    assert "using the existing checkout" in caplog.text
+
+
+def test_generate_all_recent_checkout(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    cache_dir = tmp_path / "cache"
+    (cache_dir / ".git").mkdir(parents=True)
+    (cache_dir / ".git" / "FETCH_HEAD").touch()
+    (cache_dir / "src" / "array_api_stubs").mkdir(parents=True)
+
+    def run(args: list[str], **kwargs: Any) -> None:
+        pytest.fail(f"unexpected git command {args}")
+
+    monkeypatch.setattr(sp, "run", run)
+    generate_all(cache_dir=cache_dir, out_path=tmp_path / "out")
+
+
+def test_generate_missing_types(tmp_path: Path) -> None:
+    with pytest.raises(RuntimeError, match=r"_types\.py missing"):
+        generate({}, tmp_path / "out.py")
+
+
+def test_generate_failure_keeps_output(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    out_path = tmp_path / "out.py"
+    out_path.write_text("old", "utf-8")
+
+    def unparse_body(body: list[ast.stmt]) -> Iterator[str]:
+        yield "x = 1"
+        raise ValueError
+
+    monkeypatch.setattr(_main, "_unparse_body", unparse_body)
+    with pytest.raises(ValueError):
+        generate({"_types": []}, out_path)
+    assert out_path.read_text("utf-8") == "old"
+    assert list(tmp_path.iterdir()) == [out_path]